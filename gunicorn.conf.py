@@ -0,0 +1,25 @@
+import multiprocessing
+import os
+
+
+def _cpu_count() -> int:
+    # Respect container CPU affinity where available; cpu_count() reports the host.
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY") or (2 * _cpu_count() + 1))
+workers = max(1, min(workers, int(os.getenv("MAX_WORKERS") or 8)))
+timeout = int(os.getenv("WORKER_TIMEOUT_SECONDS") or 60)
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+# Import the app once in the master so workers fork warm; per-worker warm-up runs in the lifespan.
+preload_app = True
+
+# Workers read WEB_CONCURRENCY to pick a shared state backend (see STATE_BACKEND in main.py).
+os.environ["WEB_CONCURRENCY"] = str(workers)
@@ -1,26 +1,66 @@
 from fastapi import FastAPI
+from fastapi import Header
 from fastapi import HTTPException
+import asyncio
+import gzip
+try:
+    import brotli
+except ImportError:  # optional: gzip is used when brotli is not installed
+    brotli = None
+import hashlib
+import io
 import socket
 import time
 from urllib.parse import urlparse
 import os
-import requests
 import logging
 import ssl
+import tempfile
+import threading
+import sys
 import json
+import random
+import secrets
+from fastapi import Request
 from fastapi import Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import httpx
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from copy import deepcopy
-from typing import Any, Dict, Optional
-from datetime import datetime
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Optional, Tuple
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo  # Python 3.9+
 
+if TYPE_CHECKING:
+    import sqlite3
+    import tracemalloc
+
 logger = logging.getLogger(__name__)
 
 
-app = FastAPI(title="TNT McLeod API", version="0.1.0")
+# Set once the startup warm-up has finished (successfully or not); /health reports 503 until then.
+_warmup: Dict[str, Any] = {"ready": False}
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    task = None
+    if _parse_bool_env("WARMUP_ENABLED", True):
+        task = asyncio.create_task(_run_warmup())
+    else:
+        _warmup["ready"] = True
+    yield
+    if task is not None and not task.done():
+        task.cancel()
+    for client in _upstream_clients.values():
+        client.close()
+    _upstream_clients.clear()
+
+
+app = FastAPI(title="TNT McLeod API", version="0.1.0", lifespan=_lifespan)
 
 
 @app.get("/")
@@ -30,8 +70,9 @@ async def read_root() -> dict:
 
 
 @app.get("/health")
-async def health() -> dict:
-
+async def health():
+    if not _warmup["ready"]:
+        return Response(content=json.dumps({"status": "starting"}), media_type="application/json", status_code=503)
     return {"status": "healthy"}
 
 def _parse_bool_env(var_name: str, default: bool = True) -> bool:
@@ -41,6 +82,214 @@ def _parse_bool_env(var_name: str, default: bool = True) -> bool:
     return value.strip().lower() in {"1", "true", "yes", "on"}
 
 
+# ----- Tracing -----
+# Spans follow the OpenTelemetry data model (trace/span ids, parent links, unix-nano times)
+# and are exported as OTLP/JSON, so a collector or plain file can ingest them.
+#   TRACE_SAMPLE_RATE    0.0-1.0 fraction of requests exported (default 0 = off)
+#   TRACE_EXPORT_PATH    append one OTLP/JSON document per trace to this file
+#   TRACE_OTLP_ENDPOINT  POST the same document to an OTLP/HTTP collector (…/v1/traces)
+#   SERVER_TIMING        add a Server-Timing header with per-stage durations (default off;
+#                        it exposes upstream connect/TLS timings to callers)
+# When nothing is sampled and SERVER_TIMING is off, _span() is a no-op.
+
+class _Trace:
+    def __init__(self, trace_id: str, parent_span_id: Optional[str], sampled: bool):
+        self.trace_id = trace_id
+        self.parent_span_id = parent_span_id
+        self.sampled = sampled
+        self.spans: list = []
+
+
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar("current_trace", default=None)
+_current_span_id: ContextVar[Optional[str]] = ContextVar("current_span_id", default=None)
+_trace_export_lock = threading.Lock()
+
+
+def _parse_traceparent(value: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """Parse a W3C traceparent header into (trace_id, parent_span_id, sampled)."""
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+
+@contextmanager
+def _span(name: str, **attributes: Any):
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = secrets.token_hex(8)
+    parent = _current_span_id.get() or trace.parent_span_id
+    token = _current_span_id.set(span_id)
+    start_ns = time.time_ns()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as exc:
+        error = repr(exc)
+        raise
+    finally:
+        _current_span_id.reset(token)
+        trace.spans.append({
+            "name": name,
+            "span_id": span_id,
+            "parent_span_id": parent,
+            "start_ns": start_ns,
+            "end_ns": start_ns + int((time.perf_counter() - start) * 1e9),
+            "attributes": attributes,
+            "error": error,
+        })
+
+
+def _httpx_trace_hook():
+    """
+    httpx/httpcore trace extension callback that turns connection events into spans:
+    upstream.connect (DNS + TCP), upstream.tls, upstream.send, upstream.ttfb, upstream.body.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    names = {
+        "connection.connect_tcp": "upstream.connect",
+        "connection.start_tls": "upstream.tls",
+        "http11.send_request_headers": "upstream.send",
+        "http11.send_request_body": "upstream.send_body",
+        "http11.receive_response_headers": "upstream.ttfb",
+        "http11.receive_response_body": "upstream.body",
+        "http2.send_request_headers": "upstream.send",
+        "http2.receive_response_headers": "upstream.ttfb",
+        "http2.receive_response_body": "upstream.body",
+    }
+    open_spans: Dict[str, Any] = {}
+
+    def hook(event_name: str, info: Dict[str, Any]) -> None:
+        stage, _, phase = event_name.rpartition(".")
+        name = names.get(stage)
+        if name is None:
+            return
+        if phase == "started":
+            cm = _span(name)
+            cm.__enter__()
+            open_spans[stage] = cm
+        elif phase == "complete":
+            cm = open_spans.pop(stage, None)
+            if cm is not None:
+                cm.__exit__(None, None, None)
+        elif phase == "failed":
+            cm = open_spans.pop(stage, None)
+            exc = info.get("exception")
+            if cm is not None:
+                # Hand the exception to the span so the failed stage is exported as an error.
+                if isinstance(exc, BaseException):
+                    cm.__exit__(type(exc), exc, exc.__traceback__)
+                else:
+                    cm.__exit__(RuntimeError, RuntimeError(f"{event_name}: {exc!r}"), None)
+
+    return hook
+
+
+def _otlp_document(trace: _Trace) -> Dict[str, Any]:
+    def attrs(values: Dict[str, Any]) -> list:
+        return [{"key": k, "value": {"stringValue": str(v)}} for k, v in values.items()]
+
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": attrs({"service.name": os.getenv("TRACE_SERVICE_NAME") or "tnt-mcleod-api"})},
+            "scopeSpans": [{
+                "scope": {"name": "main"},
+                "spans": [
+                    {
+                        "traceId": trace.trace_id,
+                        "spanId": s["span_id"],
+                        "parentSpanId": s["parent_span_id"] or "",
+                        "name": s["name"],
+                        "kind": 2 if s["parent_span_id"] == trace.parent_span_id else 1,
+                        "startTimeUnixNano": str(s["start_ns"]),
+                        "endTimeUnixNano": str(s["end_ns"]),
+                        "attributes": attrs(s["attributes"]),
+                        "status": {"code": 2, "message": s["error"]} if s["error"] else {"code": 1},
+                    }
+                    for s in trace.spans
+                ],
+            }],
+        }]
+    }
+
+
+def _export_trace(trace: _Trace) -> None:
+    document = _otlp_document(trace)
+    path = os.getenv("TRACE_EXPORT_PATH")
+    endpoint = os.getenv("TRACE_OTLP_ENDPOINT")
+    try:
+        if path:
+            line = json.dumps(document, separators=(",", ":"))
+            with _trace_export_lock, open(path, "a") as fh:
+                fh.write(line + "\n")
+        if endpoint:
+            httpx.post(endpoint, json=document, timeout=5.0)
+    except Exception as exc:
+        logger.warning(f"Trace export failed: {exc!r}")
+
+
+def _server_timing_header(trace: _Trace, request_ms: float) -> str:
+    totals: "OrderedDict[str, float]" = OrderedDict([("request", request_ms)])
+    for s in sorted(trace.spans, key=lambda s: s["start_ns"]):
+        totals[s["name"]] = totals.get(s["name"], 0.0) + (s["end_ns"] - s["start_ns"]) / 1e6
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in totals.items())
+
+
+class _TracingMiddleware:
+    """
+    Plain ASGI middleware, so unsampled requests pass straight through with no extra task.
+    Server-Timing is added on http.response.start; the root span closes after the body.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        sample_rate = float(os.getenv("TRACE_SAMPLE_RATE") or 0)
+        server_timing = _parse_bool_env("SERVER_TIMING", False)
+        traceparent = next((v.decode("latin-1") for k, v in scope.get("headers", []) if k == b"traceparent"), None)
+        incoming = _parse_traceparent(traceparent)
+        if incoming:
+            trace_id, parent_span_id, sampled = incoming[0], incoming[1], incoming[2] or random.random() < sample_rate
+        else:
+            trace_id, parent_span_id, sampled = secrets.token_hex(16), None, random.random() < sample_rate
+        if not sampled and not server_timing:
+            return await self.app(scope, receive, send)
+
+        trace = _Trace(trace_id, parent_span_id, sampled)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if server_timing and message["type"] == "http.response.start":
+                header = _server_timing_header(trace, (time.perf_counter() - start) * 1000)
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode("latin-1"))]}
+            await send(message)
+
+        token = _current_trace.set(trace)
+        try:
+            with _span("request", **{"http.method": scope["method"], "http.target": scope["path"]}):
+                await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_trace.reset(token)
+            if sampled:
+                asyncio.get_running_loop().run_in_executor(None, _export_trace, trace)
+
+
+app.add_middleware(_TracingMiddleware)
+
+
 def _build_order_url(base_url: str, order_id: str) -> str:
     base = (base_url or "").rstrip("/")
     if base.endswith("/orders"):
@@ -48,7 +297,65 @@ def _build_order_url(base_url: str, order_id: str) -> str:
     return f"{base}/orders/{order_id}"
 
 
+_upstream_clients: Dict[bool, httpx.Client] = {}
+_upstream_clients_lock = threading.Lock()
+
+
+def _upstream_client(verify_tls: bool) -> httpx.Client:
+    """Pooled keep-alive client per TLS-verification mode, so repeated calls skip connect/TLS."""
+    client = _upstream_clients.get(verify_tls)
+    if client is None:
+        # Warm-up and the first threadpool requests race here; only one client may win,
+        # otherwise its warmed connections are orphaned and never closed.
+        with _upstream_clients_lock:
+            client = _upstream_clients.get(verify_tls)
+            if client is None:
+                limits = httpx.Limits(
+                    max_connections=int(os.getenv("UPSTREAM_MAX_CONNECTIONS") or 20),
+                    max_keepalive_connections=int(os.getenv("UPSTREAM_MAX_KEEPALIVE") or 10),
+                    # httpx defaults to 5s, which drops warm connections between webhook bursts.
+                    keepalive_expiry=float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS") or 60),
+                )
+                client = httpx.Client(verify=verify_tls, follow_redirects=True, limits=limits)
+                _upstream_clients[verify_tls] = client
+    return client
+
+
+def _upstream_request(method: str, url: str, headers: Dict[str, str], timeout_seconds: float, verify_tls: bool, payload: Any = None) -> httpx.Response:
+    hook = _httpx_trace_hook()
+    r = _upstream_client(verify_tls).request(
+        method,
+        url,
+        headers=headers,
+        json=payload,
+        timeout=timeout_seconds,
+        extensions={"trace": hook} if hook else None,
+    )
+    # 304 only comes back when the caller sent conditional headers and is handled there.
+    if r.status_code != 304:
+        r.raise_for_status()
+    return r
+
+
+def _is_tls_error(exc: BaseException) -> bool:
+    while exc is not None:
+        if isinstance(exc, ssl.SSLError):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
 def _fetch_order_data(order_id: str) -> dict:
+    r = _fetch_order(order_id)
+    with _span("decode"):
+        return r.json()
+
+
+def _fetch_order(order_id: str, conditional_headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+    """
+    Fetch the raw upstream order response. conditional_headers (If-None-Match /
+    If-Modified-Since) are forwarded as-is, in which case a 304 response is returned.
+    """
     base_url = os.getenv('GET_URL')
     token = os.getenv('TOKEN')
     company_id = os.getenv('COMPANY_ID')
@@ -71,6 +378,8 @@ def _fetch_order_data(order_id: str) -> dict:
     }
     if host_override:
         headers.update(host_override)
+    if conditional_headers:
+        headers.update(conditional_headers)
 
     method = (os.getenv("REQUEST_METHOD") or "GET").strip().upper()
     timeout_seconds = float(os.getenv("REQUEST_TIMEOUT_SECONDS") or 15)
@@ -82,49 +391,156 @@ def _fetch_order_data(order_id: str) -> dict:
         verify_tls = False
 
     try:
-        if method == "POST":
-            payload = {}
-            r = requests.post(url_for_connect, headers=headers, json=payload, timeout=timeout_seconds, verify=verify_tls)
-        else:
-            r = requests.get(url_for_connect, headers=headers, timeout=timeout_seconds, verify=verify_tls)
-        r.raise_for_status()
-        return r.json()
-
-    except requests.exceptions.HTTPError as exc:
+        with _span("fetch", **{"http.method": method, "order_id": order_id}):
+            if method == "POST":
+                payload = {}
+                r = _upstream_request("POST", url_for_connect, headers, timeout_seconds, verify_tls, payload)
+            else:
+                r = _upstream_request("GET", url_for_connect, headers, timeout_seconds, verify_tls)
+        return r
+
+    except httpx.HTTPStatusError as exc:
         # Surface upstream status and body to the client for clarity (e.g., 403 Forbidden)
-        status = getattr(exc.response, "status_code", 502) if hasattr(exc, "response") else 502
+        status = exc.response.status_code
         try:
-            detail = exc.response.json() if exc.response is not None else str(exc)
+            detail = exc.response.json()
         except Exception:
-            detail = exc.response.text if exc.response is not None else str(exc)
+            detail = exc.response.text
         raise HTTPException(status_code=status, detail={"error": "Upstream HTTP error", "detail": detail})
-    except requests.exceptions.SSLError as exc:
-        # Likely cert name/SNI mismatch when connecting by IP
-        raise HTTPException(
-            status_code=502,
-            detail={
-                "error": "TLS error to upstream",
-                "detail": str(exc),
-                "hint": "If you must connect by IP over HTTPS, prefer an /etc/hosts entry so SNI & certs match."
-            }
-        )
-    except requests.exceptions.RequestException as exc:
+    except httpx.RequestError as exc:
+        if _is_tls_error(exc):
+            # Likely cert name/SNI mismatch when connecting by IP
+            raise HTTPException(
+                status_code=502,
+                detail={
+                    "error": "TLS error to upstream",
+                    "detail": str(exc),
+                    "hint": "If you must connect by IP over HTTPS, prefer an /etc/hosts entry so SNI & certs match."
+                }
+            )
         raise HTTPException(status_code=502, detail={"error": "Upstream connection error", "detail": str(exc)})
 
 
+# Each content coding is a different representation, so it gets its own strong validator.
+_ETAG_CODING_SUFFIXES = {"br": "-br", "gzip": "-gz"}
+
+
+def _coded_etag(etag: str, encoding: Optional[str]) -> str:
+    suffix = _ETAG_CODING_SUFFIXES.get(encoding or "", "")
+    return f'{etag[:-1]}{suffix}"' if suffix else etag
+
+
+def _match_etag(if_none_match: Optional[str], etag: str) -> Optional[str]:
+    """
+    Return the If-None-Match candidate that matches the content-hash etag, ignoring any
+    content-coding suffix (the client already holds that coding), or None.
+    """
+    if not if_none_match:
+        return None
+    for candidate in (c.strip() for c in if_none_match.split(",")):
+        if candidate == "*":
+            return etag
+        # Weak comparison per RFC 9110 for If-None-Match.
+        opaque = candidate.removeprefix("W/")
+        for suffix in _ETAG_CODING_SUFFIXES.values():
+            if opaque.endswith(f'{suffix}"'):
+                opaque = f'{opaque[:-len(suffix) - 1]}"'
+                break
+        if opaque == etag:
+            return candidate.removeprefix("W/")
+    return None
+
+
+def _pick_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def _load_data_response(order_id: str, request: Request) -> Response:
+    """
+    Return the order as {"status": "ok", "message": <order>} with:
+    - a content-hash ETag (with a -br/-gz suffix for compressed bodies), and 304 for
+      matching If-None-Match before any JSON work;
+    - upstream conditional GETs when McLeod previously returned ETag/Last-Modified;
+    - br/gzip compression for bodies over COMPRESSION_MIN_BYTES.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    validators_key = f"etag:{order_id}"
+    validators = _state.get(validators_key)
+    conditional: Dict[str, str] = {}
+    matched = _match_etag(if_none_match, validators["etag"]) if validators is not _MISSING else None
+    if matched:
+        if validators.get("upstream_etag"):
+            conditional["If-None-Match"] = validators["upstream_etag"]
+        if validators.get("upstream_last_modified"):
+            conditional["If-Modified-Since"] = validators["upstream_last_modified"]
+
+    r = _fetch_order(order_id, conditional)
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if r.status_code == 304:
+        headers["ETag"] = matched
+        return Response(status_code=304, headers=headers)
+
+    with _span("etag"):
+        etag = '"' + hashlib.blake2b(r.content, digest_size=16).hexdigest() + '"'
+    upstream_etag = r.headers.get("etag")
+    upstream_last_modified = r.headers.get("last-modified")
+    if upstream_etag or upstream_last_modified:
+        _state.set(
+            validators_key,
+            {"etag": etag, "upstream_etag": upstream_etag, "upstream_last_modified": upstream_last_modified},
+            float(os.getenv("ETAG_TTL_SECONDS") or 3600),
+        )
+    matched = _match_etag(if_none_match, etag)
+    if matched:
+        headers["ETag"] = matched
+        return Response(status_code=304, headers=headers)
+
+    with _span("decode"):
+        data = r.json()
+    with _span("serialize"):
+        content = json.dumps({"status": "ok", "message": data}, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+    encoding = _pick_encoding(request.headers.get("accept-encoding"))
+    if not encoding or len(content) < int(os.getenv("COMPRESSION_MIN_BYTES") or 1024):
+        encoding = None
+    headers["ETag"] = _coded_etag(etag, encoding)
+    if encoding:
+        with _span("compress", encoding=encoding):
+            if encoding == "br":
+                content = brotli.compress(content, quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY") or 5))
+            else:
+                content = gzip.compress(content, compresslevel=int(os.getenv("COMPRESSION_GZIP_LEVEL") or 6))
+        headers["Content-Encoding"] = encoding
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
 @app.get("/get_load_data")
-async def get_load_data(order_id: str):
+async def get_load_data(order_id: str, request: Request):
     logger.info(f"Getting load data for order {order_id}")
-    data = _fetch_order_data(order_id)
-    return {"status": "ok", "message": data}
+    # Upstream GET, hashing, encoding and compression all block; keep them off the event loop.
+    return await _run_blocking(_load_data_response, order_id, request)
 
 
 
 @app.get("/get_load_data/{order_id}")
-async def get_load_data_path(order_id: str):
+async def get_load_data_path(order_id: str, request: Request):
     logger.info(f"Getting load data for order {order_id}")
-    data = _fetch_order_data(order_id)
-    return {"status": "ok", "message": data}
+    return await _run_blocking(_load_data_response, order_id, request)
 
 
 @app.get("/health/upstream")
@@ -245,6 +661,69 @@ async def try_http(url: str):
 
 
 
+def _open_upstream_connection(url: str, headers: Dict[str, str], verify_tls: bool, timeout_seconds: float) -> Dict[str, Any]:
+    """Unauthenticated HEAD that leaves a live (TLS) connection in the pool; any status counts."""
+    t0 = time.perf_counter()
+    try:
+        r = _upstream_client(verify_tls).request("HEAD", url, headers=headers, timeout=timeout_seconds)
+        return {"ok": True, "status": r.status_code, "ms": round((time.perf_counter() - t0) * 1000)}
+    except Exception as e:
+        return {"ok": False, "error": repr(e), "ms": round((time.perf_counter() - t0) * 1000)}
+
+
+async def _warm_up() -> Dict[str, Any]:
+    """
+    Pay cold-start costs before traffic arrives:
+    - load America/Chicago tz data;
+    - resolve the McLeod host;
+    - open WARMUP_CONNECTIONS pooled keep-alive connections (TCP + TLS handshake) so the
+      first real requests reuse them.
+    """
+    loop = asyncio.get_running_loop()
+    report: Dict[str, Any] = {}
+
+    t0 = time.perf_counter()
+    ZoneInfo("America/Chicago")
+    report["tzdata_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    base_url = os.getenv("GET_URL")
+    if not base_url:
+        report["upstream"] = "skipped: GET_URL not set"
+        return report
+    url = base_url if "://" in base_url else f"https://{base_url}"
+    url_for_connect, host_override = _prepare_target(url)
+    parsed = urlparse(url_for_connect)
+    port = parsed.port or (443 if (parsed.scheme or "https").lower() == "https" else 80)
+    report["dns"] = await loop.run_in_executor(None, try_dns, parsed.hostname)
+
+    verify_tls = _parse_bool_env("REQUESTS_VERIFY", True)
+    if os.getenv("UPSTREAM_CONNECT_IP") and url.lower().startswith("https://") and os.getenv("REQUESTS_VERIFY") is None:
+        verify_tls = False
+    timeout_seconds = float(os.getenv("REQUEST_TIMEOUT_SECONDS") or 15)
+    count = int(os.getenv("WARMUP_CONNECTIONS") or 2)
+    report["connections"] = list(await asyncio.gather(*[
+        loop.run_in_executor(None, _open_upstream_connection, url_for_connect, host_override or {}, verify_tls, timeout_seconds)
+        for _ in range(count)
+    ]))
+    report["host"], report["port"] = parsed.hostname, port
+    return report
+
+
+async def _run_warmup() -> None:
+    t0 = time.perf_counter()
+    try:
+        report = await asyncio.wait_for(_warm_up(), timeout=float(os.getenv("WARMUP_TIMEOUT_SECONDS") or 10))
+    except asyncio.TimeoutError:
+        report = {"error": "warm-up timed out"}
+    except Exception as exc:
+        report = {"error": repr(exc)}
+    report["total_ms"] = round((time.perf_counter() - t0) * 1000)
+    # Logged only: the report holds resolved upstream IPs and errors, not for public /health.
+    logger.info(f"Startup warm-up finished: {report}")
+    # Ready even if warm-up failed: requests then just pay the cold costs themselves.
+    _warmup["ready"] = True
+
+
 @app.get("/health/upstream-debug")
 async def upstream_debug():
     dns_res = try_dns(UP_HOST)
@@ -303,7 +782,8 @@ def transform_payload(
     print("=== TRANSFORM_PAYLOAD CALLED ===")
     print(f"Extracted arrival: {extracted_actual_arrival}")
     print(f"Extracted departure: {extracted_actual_departure}")
-    data = deepcopy(payload)
+    with _span("deepcopy"):
+        data = deepcopy(payload)
 
 
     print(f"Payload keys: {list(data.keys()) if isinstance(data, dict) else 'Not a dict'}")
@@ -530,10 +1010,15 @@ FIELDS_TO_REMOVE = {"planning", "order_planning4", "order_planning3", "order_pla
 
 def _remove_fields(obj: Any) -> Any:
     """Recursively remove unwanted keys from any JSON-like Python object."""
+    with _span("remove_fields"):
+        return _remove_fields_recursive(obj)
+
+
+def _remove_fields_recursive(obj: Any) -> Any:
     if isinstance(obj, dict):
-        return {k: _remove_fields(v) for k, v in obj.items() if k not in FIELDS_TO_REMOVE}
+        return {k: _remove_fields_recursive(v) for k, v in obj.items() if k not in FIELDS_TO_REMOVE}
     if isinstance(obj, list):
-        return [_remove_fields(v) for v in obj]
+        return [_remove_fields_recursive(v) for v in obj]
     return obj  # primitives
 
 
@@ -611,8 +1096,315 @@ class UpdateBrokerageStatusRequest(BaseModel):
     brokerage_status: str
 
 
+_MISSING = object()
+
+
+class _MemoryStateBackend:
+    """
+    Per-process TTL key/value store with lease support.
+    Used for caches, idempotency records and rate-limit tokens when running a single worker.
+    """
+
+    def __init__(self, max_entries: int):
+        self._max = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._leases: Dict[str, float] = {}
+        # Backend calls run in threadpool threads, so check-then-set must be atomic.
+        self._lock = threading.RLock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] < time.time():
+                self._entries.pop(key, None)
+                return _MISSING
+            return entry[1]
+
+    def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl_seconds, value)
+            while len(self._entries) > self._max:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def acquire(self, key: str, ttl_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            expires = self._leases.get(key)
+            if expires is not None and expires > now:
+                return False
+            self._leases[key] = now + ttl_seconds
+            return True
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._leases.pop(key, None)
+
+    def incr(self, key: str, ttl_seconds: float) -> int:
+        with self._lock:
+            value = self.get(key)
+            value = 1 if value is _MISSING else value + 1
+            self.set(key, value, ttl_seconds)
+            return value
+
+
+class _SQLiteStateBackend:
+    """
+    File-backed TTL key/value store shared by every worker process on the host.
+    Values are stored as JSON; leases are rows in a separate table so an in-flight
+    update in one worker holds duplicates arriving at another worker.
+    """
+
+    def __init__(self, path: str, max_entries: int, busy_timeout: float = 1.0):
+        self._path = path
+        self._max = max_entries
+        self._busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._conn: "Optional[sqlite3.Connection]" = None
+        self._pid: Optional[int] = None
+        self._writes = 0
+
+    def _connection(self) -> "sqlite3.Connection":
+        # Connections must not cross a fork, so reconnect in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            import sqlite3  # only needed for the shared backend; keeps cold start lean
+            # Callers run backend calls in the threadpool, so a busy wait never blocks the event loop.
+            conn = sqlite3.connect(self._path, timeout=self._busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM kv WHERE key = ? AND expires >= ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else _MISSING
+
+    def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl_seconds),
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                conn.execute("DELETE FROM kv WHERE expires < ?", (now,))
+                conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+                conn.execute(
+                    "DELETE FROM kv WHERE key IN (SELECT key FROM kv ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                    (self._max,),
+                )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def acquire(self, key: str, ttl_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT expires FROM leases WHERE key = ?", (key,)).fetchone()
+                if row and row[0] > now:
+                    return False
+                conn.execute("INSERT OR REPLACE INTO leases (key, expires) VALUES (?, ?)", (key, now + ttl_seconds))
+                return True
+            finally:
+                conn.execute("COMMIT")
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM leases WHERE key = ?", (key,))
+
+    def incr(self, key: str, ttl_seconds: float) -> int:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM kv WHERE key = ? AND expires >= ?", (key, now)).fetchone()
+                value = json.loads(row[0]) + 1 if row else 1
+                conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), now + ttl_seconds))
+                return value
+            finally:
+                conn.execute("COMMIT")
+
+
+def _build_state_backend():
+    """
+    STATE_BACKEND=memory|sqlite|auto (default auto). Auto picks sqlite when more than
+    one worker is configured (WEB_CONCURRENCY > 1) so all workers share the same state.
+    """
+    choice = (os.getenv("STATE_BACKEND") or "auto").strip().lower()
+    max_entries = int(os.getenv("STATE_MAX_ENTRIES") or os.getenv("IDEMPOTENCY_MAX_ENTRIES") or 1024)
+    if choice == "auto":
+        choice = "sqlite" if int(os.getenv("WEB_CONCURRENCY") or 1) > 1 else "memory"
+    if choice == "sqlite":
+        path = os.getenv("STATE_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "tnt_mcleod_state.sqlite3")
+        logger.info(f"Using SQLite state backend at {path}")
+        return _SQLiteStateBackend(path, max_entries, float(os.getenv("STATE_SQLITE_BUSY_TIMEOUT_SECONDS") or 1))
+    return _MemoryStateBackend(max_entries)
+
+
+_state = _build_state_backend()
+
+
+class _IdempotencyStore:
+    """
+    TTL cache of update responses keyed by idempotency key, kept in the shared state backend.
+    - A repeat of a completed key returns the cached response without touching McLeod.
+    - A repeat of an in-flight key (in this or another worker) waits for the first call to
+      finish, then reuses its result.
+    - Failures are never cached; the next waiter (or retry) runs the update again.
+    - Derived keys are scoped per order: a newer successful write to the same order drops
+      older derived entries so A -> B -> A status sequences are not swallowed.
+    - Each record carries a fingerprint of the order id and request fields; reusing a key
+      with a different payload is rejected with 422 instead of replaying another response.
+    """
+
+    def __init__(self, backend, ttl_seconds: float, lease_seconds: float, poll_seconds: float = 0.05):
+        self._backend = backend
+        self._ttl = ttl_seconds
+        self._lease_ttl = lease_seconds
+        self._poll = poll_seconds
+        self._inflight: Dict[str, asyncio.Event] = {}
+
+    def get(self, key: str) -> Any:
+        return self._backend.get(f"idem:{key}")
+
+    def put(self, key: str, value: Any, fingerprint: str, scope: str, derived: bool) -> None:
+        scope_key = f"idem-scope:{scope}"
+        derived_keys = self._backend.get(scope_key)
+        derived_keys = [] if derived_keys is _MISSING else derived_keys
+        for stale in derived_keys:
+            if stale != key:
+                self._backend.delete(f"idem:{stale}")
+        self._backend.set(f"idem:{key}", {"fingerprint": fingerprint, "response": value}, self._ttl)
+        self._backend.set(scope_key, [key] if derived else [], self._ttl)
+
+    async def run(self, key: str, fingerprint: str, scope: str, derived: bool, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result, replayed). Backend calls go through the threadpool: SQLite may block."""
+        lease_key = f"idem-lease:{key}"
+        while True:
+            cached = await run_in_threadpool(self.get, key)
+            if cached is not _MISSING:
+                if cached["fingerprint"] != fingerprint:
+                    raise HTTPException(status_code=422, detail={
+                        "error": "Idempotency-Key reused with a different request",
+                        "hint": "Send a new Idempotency-Key for a different order or payload.",
+                    })
+                return cached["response"], True
+            pending = self._inflight.get(key)
+            if pending is not None:
+                await pending.wait()
+                continue
+            if await run_in_threadpool(self._backend.acquire, lease_key, self._lease_ttl):
+                break
+            # Another worker holds the lease; poll until it publishes a result or gives up.
+            await asyncio.sleep(self._poll)
+
+        event = asyncio.Event()
+        self._inflight[key] = event
+        try:
+            result = await fn()
+            await run_in_threadpool(self.put, key, result, fingerprint, scope, derived)
+            return result, False
+        finally:
+            await run_in_threadpool(self._backend.release, lease_key)
+            self._inflight.pop(key, None)
+            event.set()
+
+
+_idempotency_store = _IdempotencyStore(
+    _state,
+    ttl_seconds=float(os.getenv("IDEMPOTENCY_TTL_SECONDS") or 300),
+    # A crashed worker must not block duplicates forever: the lease outlives a GET + PUT.
+    lease_seconds=2 * float(os.getenv("REQUEST_TIMEOUT_SECONDS") or 15) + 5,
+)
+
+
+def _idempotency_key(endpoint: str, header_key: Optional[str], *parts: Optional[str]) -> Tuple[Optional[str], bool]:
+    """
+    Return (key, derived). An explicit Idempotency-Key header wins; otherwise a key is
+    derived from the request fields when IDEMPOTENCY_AUTO_KEYS is on. None disables dedupe.
+    """
+    if not _parse_bool_env("IDEMPOTENCY_ENABLED", True):
+        return None, False
+    if header_key and header_key.strip():
+        return f"{endpoint}:key:{header_key.strip()}", False
+    if not _parse_bool_env("IDEMPOTENCY_AUTO_KEYS", True):
+        return None, False
+    return f"{endpoint}:auto:" + json.dumps(list(parts)), True
+
+
+async def _run_idempotent(
+    endpoint: str,
+    order_id: str,
+    header_key: Optional[str],
+    parts: Tuple[Optional[str], ...],
+    response: Response,
+    fn: Callable[[], Awaitable[Any]],
+) -> Any:
+    key, derived = _idempotency_key(endpoint, header_key, order_id, *parts)
+    if key is None:
+        return await fn()
+    fingerprint = hashlib.sha256(json.dumps([endpoint, order_id, *parts]).encode("utf-8")).hexdigest()
+    result, replayed = await _idempotency_store.run(key, fingerprint, f"order:{order_id}", derived, fn)
+    if replayed:
+        logger.info(f"Idempotent replay for {endpoint} order {order_id}")
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
 @app.post("/update_load_data")
-async def update_load_data(body: UpdateLoadDataRequest):
+async def update_load_data(
+    body: UpdateLoadDataRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    return await _run_idempotent(
+        "update_load_data",
+        body.order_id,
+        idempotency_key,
+        (body.extracted_arrival, body.extracted_departure),
+        response,
+        # Blocking GET/transform/PUT runs off the event loop so duplicates can wait on it.
+        lambda: _run_blocking(_apply_load_data_update, body),
+    )
+
+
+@app.post("/update_brokerage_status")
+async def update_brokerage_status(
+    body: UpdateBrokerageStatusRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    return await _run_idempotent(
+        "update_brokerage_status",
+        body.order_id,
+        idempotency_key,
+        (body.brokerage_status,),
+        response,
+        lambda: _run_blocking(_apply_brokerage_status_update, body),
+    )
+
+
+def _apply_load_data_update(body: UpdateLoadDataRequest):
     print("=== UPDATE_LOAD_DATA ENDPOINT CALLED ===")
     order_id = body.order_id
     print(f"Order ID: {order_id}")
@@ -626,11 +1418,12 @@ async def update_load_data(body: UpdateLoadDataRequest):
     current = _fetch_order_data(order_id)
     logger.info(f"Fetched order data, keys: {list(current.keys()) if isinstance(current, dict) else 'Not a dict'}")
     
-    data_cleaned = transform_payload(
-        current,
-        extracted_actual_arrival=body.extracted_arrival,
-        extracted_actual_departure=body.extracted_departure,
-    )
+    with _span("transform"):
+        data_cleaned = transform_payload(
+            current,
+            extracted_actual_arrival=body.extracted_arrival,
+            extracted_actual_departure=body.extracted_departure,
+        )
     logger.info(f"After transformation, data_cleaned keys: {list(data_cleaned.keys()) if isinstance(data_cleaned, dict) else 'Not a dict'}")
 
     base_url = os.getenv('GET_URL')
@@ -663,29 +1456,25 @@ async def update_load_data(body: UpdateLoadDataRequest):
     logger.info(f"Payload size: {len(str(data_cleaned))} characters")
 
     try:
-        if update_method == "POST":
-            r = requests.post(url_for_connect, headers=headers, json=data_cleaned, timeout=timeout_seconds, verify=verify_tls)
-        elif update_method == "PATCH":
-            r = requests.patch(url_for_connect, headers=headers, json=data_cleaned, timeout=timeout_seconds, verify=verify_tls)
-        else:
-            r = requests.put(url_for_connect, headers=headers, json=data_cleaned, timeout=timeout_seconds, verify=verify_tls)
-        r.raise_for_status()
+        if update_method not in ("POST", "PATCH"):
+            update_method = "PUT"
+        with _span("update", **{"http.method": update_method, "order_id": body.order_id}):
+            r = _upstream_request(update_method, url_for_connect, headers, timeout_seconds, verify_tls, data_cleaned)
         return {"status": "ok", "message": r.json()}
-    except requests.exceptions.HTTPError as exc:
-        status = getattr(exc.response, "status_code", 502) if hasattr(exc, "response") else 502
+    except httpx.HTTPStatusError as exc:
+        status = exc.response.status_code
         try:
-            detail = exc.response.json() if exc.response is not None else str(exc)
+            detail = exc.response.json()
         except Exception:
-            detail = exc.response.text if exc.response is not None else str(exc)
+            detail = exc.response.text
         raise HTTPException(status_code=status, detail={"error": "Upstream HTTP error", "detail": detail})
-    except requests.exceptions.SSLError as exc:
-        raise HTTPException(status_code=502, detail={"error": "TLS error to upstream", "detail": str(exc)})
-    except requests.exceptions.RequestException as exc:
+    except httpx.RequestError as exc:
+        if _is_tls_error(exc):
+            raise HTTPException(status_code=502, detail={"error": "TLS error to upstream", "detail": str(exc)})
         raise HTTPException(status_code=502, detail={"error": "Upstream connection error", "detail": str(exc)})
 
 
-@app.post("/update_brokerage_status")
-async def update_brokerage_status(body: UpdateBrokerageStatusRequest):
+def _apply_brokerage_status_update(body: UpdateBrokerageStatusRequest):
     order_id = body.order_id
     new_brokerage_status = body.brokerage_status
     logger.info(f"Updating brokerage status for order {order_id} to {new_brokerage_status}")
@@ -698,7 +1487,8 @@ async def update_brokerage_status(body: UpdateBrokerageStatusRequest):
     logger.info(f"Order data sample: {str(current)[:500]}...")
     
     # Create a deep copy to avoid modifying the original
-    data_cleaned = deepcopy(current)
+    with _span("deepcopy"):
+        data_cleaned = deepcopy(current)
     
     # Update only the movements[0].brokerage_status field
     # Try to find movements in different possible locations
@@ -756,22 +1546,372 @@ async def update_brokerage_status(body: UpdateBrokerageStatusRequest):
     logger.info(f"Payload size: {len(str(data_cleaned))} characters")
 
     try:
-        if update_method == "POST":
-            r = requests.post(url_for_connect, headers=headers, json=data_cleaned, timeout=timeout_seconds, verify=verify_tls)
-        elif update_method == "PATCH":
-            r = requests.patch(url_for_connect, headers=headers, json=data_cleaned, timeout=timeout_seconds, verify=verify_tls)
-        else:
-            r = requests.put(url_for_connect, headers=headers, json=data_cleaned, timeout=timeout_seconds, verify=verify_tls)
-        r.raise_for_status()
+        if update_method not in ("POST", "PATCH"):
+            update_method = "PUT"
+        with _span("update", **{"http.method": update_method, "order_id": body.order_id}):
+            r = _upstream_request(update_method, url_for_connect, headers, timeout_seconds, verify_tls, data_cleaned)
         return {"status": "ok", "message": r.json()}
-    except requests.exceptions.HTTPError as exc:
-        status = getattr(exc.response, "status_code", 502) if hasattr(exc, "response") else 502
+    except httpx.HTTPStatusError as exc:
+        status = exc.response.status_code
         try:
-            detail = exc.response.json() if exc.response is not None else str(exc)
+            detail = exc.response.json()
         except Exception:
-            detail = exc.response.text if exc.response is not None else str(exc)
+            detail = exc.response.text
         raise HTTPException(status_code=status, detail={"error": "Upstream HTTP error", "detail": detail})
-    except requests.exceptions.SSLError as exc:
-        raise HTTPException(status_code=502, detail={"error": "TLS error to upstream", "detail": str(exc)})
-    except requests.exceptions.RequestException as exc:
+    except httpx.RequestError as exc:
+        if _is_tls_error(exc):
+            raise HTTPException(status_code=502, detail={"error": "TLS error to upstream", "detail": str(exc)})
         raise HTTPException(status_code=502, detail={"error": "Upstream connection error", "detail": str(exc)})
+
+
+# ----- Profiling -----
+# Opt-in, admin-gated hot-path profiling. POST /debug/profile arms a session in the shared
+# state backend; every worker picks it up (within PROFILE_POLL_SECONDS) and profiles its
+# share of the next N requests or T seconds, whichever ends first. Each worker publishes
+# its results under its own slot and GET /debug/profile merges them.
+# Modes:
+#   sample   - background thread samples request threads (event loop + threadpool);
+#              output is folded stacks ("frame;frame;frame count") for flamegraph.pl / speedscope
+#   cprofile - deterministic cProfile on the event loop and in threadpool calls made through
+#              _run_blocking (one profiler covers all threads on Python 3.12+); output is
+#              pstats text sorted by cumulative time, one block per pid
+# With tracemalloc on, each profiled request also gets a snapshot diff of its top allocations.
+# Requires ADMIN_TOKEN; requests must send it in X-Admin-Token.
+
+_PROFILE_KEY = "profile:session"
+# Leaf frames in these modules mean the thread is idle (waiting for work or I/O).
+_IDLE_MODULES = ("threading.py", "queue.py", "selectors.py")
+
+
+class ProfileSessionRequest(BaseModel):
+    requests: int = 10
+    seconds: float = 60.0
+    mode: str = "sample"
+    interval_ms: float = 5.0
+    tracemalloc: bool = True
+
+
+class _StackSampler:
+    def __init__(self, interval_seconds: float, counts: Dict[str, int]):
+        self._interval = interval_seconds
+        self._counts = counts
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or os.path.basename(frame.f_code.co_filename) in _IDLE_MODULES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self._counts[key] = self._counts.get(key, 0) + 1
+
+
+class _LocalProfile:
+    """This worker's participation in the shared profiling session."""
+
+    def __init__(self, session: Dict[str, Any]):
+        # Profiling modules are imported on first use so they stay out of the cold-start path.
+        import tracemalloc
+
+        self.session_id = session["id"]
+        self.options = ProfileSessionRequest(**session["options"])
+        self.deadline = session["deadline"]
+        self.results_ttl = self.options.seconds + float(os.getenv("PROFILE_RESULTS_TTL_SECONDS") or 3600)
+        self.active = True
+        self.busy = False
+        self.folded: Dict[str, int] = {}
+        self.stats = None
+        self.requests: list = []
+        self.slot: Optional[int] = None
+        if self.options.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(int(os.getenv("PROFILE_TRACEMALLOC_FRAMES") or 10))
+            self.owns_tracemalloc = True
+        else:
+            self.owns_tracemalloc = False
+
+    async def claim(self) -> bool:
+        """Take one request from the shared budget; finish locally once it is spent."""
+        if not self.active:
+            return False
+        if time.time() >= self.deadline or await run_in_threadpool(_state.incr, f"profile:{self.session_id}:claimed", self.results_ttl) > self.options.requests:
+            self.finish()
+            return False
+        return True
+
+    def finish(self) -> None:
+        if not self.active:
+            return
+        self.active = False
+        if self.owns_tracemalloc:
+            import tracemalloc
+
+            tracemalloc.stop()
+
+    def add_profilers(self, profilers: list) -> None:
+        import pstats
+
+        for profiler in profilers:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+
+    def publish(self) -> None:
+        if self.slot is None:
+            self.slot = _state.incr(f"profile:{self.session_id}:workers", self.results_ttl)
+        pstats_text = ""
+        if self.stats is not None:
+            out = io.StringIO()
+            self.stats.stream = out
+            self.stats.sort_stats("cumulative").print_stats(int(os.getenv("PROFILE_STATS_LIMIT") or 60))
+            pstats_text = out.getvalue()
+        _state.set(
+            f"profile:{self.session_id}:worker:{self.slot}",
+            {"pid": os.getpid(), "requests": self.requests, "folded": self.folded, "pstats": pstats_text},
+            self.results_ttl,
+        )
+
+
+_local_profile: Optional[_LocalProfile] = None
+_profile_checked_at = 0.0
+_request_profilers: ContextVar[Optional[list]] = ContextVar("request_profilers", default=None)
+
+
+async def _armed_profile() -> Optional[_LocalProfile]:
+    """Return this worker's view of the shared session, re-reading the backend at most every PROFILE_POLL_SECONDS."""
+    global _local_profile, _profile_checked_at
+    now = time.monotonic()
+    if now - _profile_checked_at >= float(os.getenv("PROFILE_POLL_SECONDS") or 1):
+        _profile_checked_at = now
+        session = await run_in_threadpool(_state.get, _PROFILE_KEY)
+        if session is _MISSING or time.time() >= session["deadline"]:
+            session = None
+        if _local_profile is not None and (session is None or session["id"] != _local_profile.session_id):
+            _local_profile.finish()
+            _local_profile = None
+        if session is not None and _local_profile is None:
+            _local_profile = _LocalProfile(session)
+    if _local_profile is not None and not _local_profile.active:
+        return None
+    return _local_profile
+
+
+async def _run_blocking(fn: Callable[..., Any], *args: Any) -> Any:
+    """run_in_threadpool that also cProfiles the call when the current request is being profiled."""
+    profilers = _request_profilers.get()
+    # On 3.12+ cProfile is built on sys.monitoring, so the event-loop profiler already sees
+    # every thread and a second one would fail with "Another profiling tool is already active".
+    if profilers is None or sys.version_info >= (3, 12):
+        return await run_in_threadpool(fn, *args)
+
+    def profiled() -> Any:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler owns the hook; run unprofiled rather than failing the request.
+            return fn(*args)
+        profilers.append(profiler)
+        try:
+            return fn(*args)
+        finally:
+            profiler.disable()
+
+    return await run_in_threadpool(profiled)
+
+
+def _require_admin(token: Optional[str]) -> None:
+    expected = os.getenv("ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=404, detail={"error": "Profiling disabled", "hint": "Set ADMIN_TOKEN to enable /debug/profile"})
+    # Compare bytes: compare_digest rejects non-ASCII str with TypeError.
+    if not token or not secrets.compare_digest(token.encode("utf-8"), expected.encode("utf-8")):
+        raise HTTPException(status_code=403, detail={"error": "Invalid admin token"})
+
+
+def _allocation_diff(before: "tracemalloc.Snapshot", after: "tracemalloc.Snapshot", limit: int = 15) -> list:
+    import tracemalloc
+
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_diff_kb": round(stat.size_diff / 1024, 1),
+            "count_diff": stat.count_diff,
+        }
+        for stat in stats[:limit]
+        if stat.size_diff > 0
+    ]
+
+
+class _ProfilingMiddleware:
+    """Plain ASGI middleware; requests pass straight through unless a session is armed."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/debug/"):
+            return await self.app(scope, receive, send)
+        local = await _armed_profile()
+        # One profiled request at a time keeps samples and allocation diffs attributable.
+        if local is None or local.busy or not await local.claim():
+            return await self.app(scope, receive, send)
+
+        import cProfile
+        import tracemalloc
+
+        status = {"code": None}
+
+        async def send_capturing_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        local.busy = True
+        sampler = None
+        before = None
+        profilers: list = []
+        loop_profiler = None
+        token = _request_profilers.set(profilers if local.options.mode == "cprofile" else None)
+        try:
+            if local.options.tracemalloc and tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+                before = tracemalloc.take_snapshot()
+                start_mem = tracemalloc.get_traced_memory()[0]
+            if local.options.mode == "cprofile":
+                loop_profiler = cProfile.Profile()
+                profilers.append(loop_profiler)
+                loop_profiler.enable()
+            else:
+                sampler = _StackSampler(max(local.options.interval_ms, 1.0) / 1000, local.folded)
+                sampler.start()
+            start = time.perf_counter()
+            await self.app(scope, receive, send_capturing_status)
+            duration_ms = round((time.perf_counter() - start) * 1000, 1)
+        finally:
+            _request_profilers.reset(token)
+            if sampler is not None:
+                sampler.stop()
+            if loop_profiler is not None:
+                loop_profiler.disable()
+            local.busy = False
+
+        record: Dict[str, Any] = {"pid": os.getpid(), "method": scope["method"], "path": scope["path"], "status": status["code"], "duration_ms": duration_ms}
+        if before is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            record["peak_kb"] = round((peak - start_mem) / 1024, 1)
+            record["retained_kb"] = round((current - start_mem) / 1024, 1)
+            record["top_allocations"] = _allocation_diff(before, tracemalloc.take_snapshot())
+        local.requests.append(record)
+        local.add_profilers(profilers)
+        await run_in_threadpool(local.publish)
+
+
+app.add_middleware(_ProfilingMiddleware)
+
+
+def _profile_results(session: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge the per-worker records of a session."""
+    session_id = session["id"]
+    workers = _state.get(f"profile:{session_id}:workers")
+    records = []
+    for slot in range(1, (0 if workers is _MISSING else workers) + 1):
+        record = _state.get(f"profile:{session_id}:worker:{slot}")
+        if record is not _MISSING:
+            records.append(record)
+    folded: Dict[str, int] = {}
+    for record in records:
+        for stack, count in record["folded"].items():
+            folded[stack] = folded.get(stack, 0) + count
+    claimed = _state.get(f"profile:{session_id}:claimed")
+    claimed = 0 if claimed is _MISSING else claimed
+    requests = session["options"]["requests"]
+    seconds_left = max(round(session["deadline"] - time.time(), 1), 0)
+    return {
+        "id": session_id,
+        "mode": session["options"]["mode"],
+        "active": seconds_left > 0 and claimed < requests,
+        "started_at": session["started_at"],
+        "remaining_requests": max(requests - claimed, 0),
+        "seconds_left": seconds_left,
+        "workers": [record["pid"] for record in records],
+        "requests": sorted((r for record in records for r in record["requests"]), key=lambda r: r["pid"]),
+        "folded": "\n".join(f"{stack} {count}" for stack, count in sorted(folded.items())),
+        "pstats": "\n".join(f"# pid {record['pid']}\n{record['pstats']}" for record in records if record["pstats"]),
+    }
+
+
+@app.post("/debug/profile")
+async def start_profile(body: ProfileSessionRequest, x_admin_token: Optional[str] = Header(None)):
+    global _profile_checked_at
+    _require_admin(x_admin_token)
+    if body.mode not in ("sample", "cprofile"):
+        raise HTTPException(status_code=400, detail={"error": "Unsupported mode", "supported": ["sample", "cprofile"]})
+    if body.requests < 1 or body.seconds <= 0:
+        raise HTTPException(status_code=400, detail={"error": "requests and seconds must be positive"})
+    session = {
+        "id": secrets.token_hex(8),
+        "options": {
+            "requests": body.requests,
+            "seconds": body.seconds,
+            "mode": body.mode,
+            "interval_ms": body.interval_ms,
+            "tracemalloc": body.tracemalloc,
+        },
+        "deadline": time.time() + body.seconds,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+    }
+    # Keep the session record past its deadline so results stay readable.
+    await run_in_threadpool(_state.set, _PROFILE_KEY, session, body.seconds + float(os.getenv("PROFILE_RESULTS_TTL_SECONDS") or 3600))
+    _profile_checked_at = 0.0  # arm this worker immediately
+    return {"status": "ok", "message": await run_in_threadpool(_profile_results, session)}
+
+
+@app.get("/debug/profile")
+async def get_profile(format: str = "json", x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    session = await run_in_threadpool(_state.get, _PROFILE_KEY)
+    if session is _MISSING:
+        raise HTTPException(status_code=404, detail={"error": "No profiling session"})
+    results = await run_in_threadpool(_profile_results, session)
+    if format == "folded":
+        return Response(content=results["folded"], media_type="text/plain")
+    if format == "pstats":
+        return Response(content=results["pstats"], media_type="text/plain")
+    return {"status": "ok", "message": results}
+
+
+@app.delete("/debug/profile")
+async def stop_profile(x_admin_token: Optional[str] = Header(None)):
+    global _local_profile, _profile_checked_at
+    _require_admin(x_admin_token)
+    await run_in_threadpool(_state.delete, _PROFILE_KEY)
+    if _local_profile is not None:
+        _local_profile.finish()
+    _local_profile = None
+    _profile_checked_at = 0.0
+    return {"status": "ok"}